@@ -1,12 +1,23 @@
 import os
-from typing import List, Dict, Union, Optional
+import json
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain
+from textwrap import dedent
+from typing import List, Dict, Union, Optional, Tuple
 from dataclasses import dataclass
 from datetime import datetime
+from zoneinfo import ZoneInfo
 import logging
+import threading
 from dotenv import load_dotenv
-import pytz
+import msgspec
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, ResponseError
+from urllib3.util.retry import Retry
 from openai import OpenAI
 
 # Configure logging
@@ -16,13 +27,61 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv()
 
-@dataclass
+# Timezone and format used to display price publish times
+NY_TZ = ZoneInfo('America/New_York')
+TIME_FORMAT = "%Y-%m-%d %I:%M %p %Z"
+
+def _fmt_time(publish_time: int) -> str:
+    """Format a Unix publish time in New York time."""
+    return datetime.fromtimestamp(publish_time, tz=NY_TZ).strftime(TIME_FORMAT)
+
+# Powers of ten for the exponents Pyth feeds use, indexed by expo + 18
+POW10 = [10.0 ** e for e in range(-18, 1)]
+
+def _scale(expo: int) -> float:
+    """Return 10 ** expo, using the precomputed table when possible."""
+    return POW10[expo + 18] if -18 <= expo <= 0 else 10.0 ** expo
+
+# Seconds between background refreshes of the price feed catalog
+FEED_REFRESH_INTERVAL = 3600
+
+# Seconds a price answer is reused for an identical follow-up request
+LAST_RESULT_TTL = 1.0
+
+# Connect/read timeouts for Hermes requests, and the longest Retry-After worth waiting for
+HERMES_TIMEOUT = (3.05, 10)
+MAX_RETRY_AFTER = 5
+
+# Seconds a caller waits on an identical in-flight price request; covers the
+# worst case of the Hermes timeouts and retries above
+INFLIGHT_WAIT_TIMEOUT = 60
+
+# Maximum number of feed ids sent in a single Hermes price request
+PRICE_BATCH_SIZE = 50
+
+# Structured output schema enforced on the GPT message analysis
+ANALYSIS_SCHEMA = {
+    "name": "message_analysis",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "is_price_request": {"type": "boolean"},
+            "tickers": {"type": "array", "items": {"type": "string"}},
+            "chat_response": {"type": "string"},
+        },
+        "required": ["is_price_request", "tickers", "chat_response"],
+        "additionalProperties": False,
+    },
+}
+
+@dataclass(frozen=True, slots=True)
 class PriceFeed:
     """Data class for price feed information."""
     id: str
     description: str
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class PriceData:
     """Data class for price information."""
     id: str
@@ -31,20 +90,127 @@ class PriceData:
     description: str
     time: str
 
+class HermesPrice(msgspec.Struct):
+    """Price fields of a Hermes price update."""
+    price: float
+    conf: float
+    expo: int
+    publish_time: int
+
+class HermesPriceUpdate(msgspec.Struct):
+    """Single parsed price update returned by Hermes."""
+    id: str
+    price: HermesPrice
+
+class HermesPriceResponse(msgspec.Struct):
+    """Latest-price response; fields not declared here are skipped when decoding."""
+    parsed: List[HermesPriceUpdate]
+
+class HermesRetry(Retry):
+    """Retry policy that gives up instead of sleeping through a long Retry-After."""
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if response is not None:
+            retry_after = self.get_retry_after(response)
+            if retry_after is not None and retry_after > MAX_RETRY_AFTER:
+                # With raise_on_status=False urllib3 hands this response back to the caller
+                raise MaxRetryError(_pool, url, ResponseError(f"Retry-After of {retry_after}s is too long"))
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
 class HermesClient:
     """Client for interacting with the Hermes API."""
     
     def __init__(self, base_url: str):
         self.BASE_URL = base_url
-        self.session = requests.Session()    
+        self.session = requests.Session()
+        # Accept-Encoding is left to requests, which only offers codecs it can decode
+        self.session.headers.update({
+            "Accept": "application/json",
+            "User-Agent": "pythia-python/1.0",
+        })
+        # Pool connections and retry transient failures with jittered backoff,
+        # keeping the total wait short enough for a live price answer.
+        # raise_on_status=False hands the final response back so
+        # raise_for_status() still surfaces it as an HTTPError.
+        retry = HermesRetry(
+            total=2,
+            backoff_factor=0.5,
+            backoff_max=10,
+            backoff_jitter=1.0,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["GET"]),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=50, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # Short-lived response caches; the feed catalog changes far less often than prices
+        self._price_ttl = 2.0
+        self._price_cache: Dict[Tuple[str, ...], Tuple[float, HermesPriceResponse]] = {}
+        self._feeds_ttl = 3600.0
+        self._feeds_cache: Optional[Tuple[float, List[Dict]]] = None
+        self._inflight: Dict[Tuple[str, ...], Future] = {}
+        self._inflight_lock = threading.Lock()
     
-    def get_price_feeds(self) -> List[Dict]:
+    def get_price_feeds(self, use_cache: bool = True) -> List[Dict]:
         """Fetch all available price feeds."""
-        response = self.session.get(f"{self.BASE_URL}/v2/price_feeds")
+        now = time.monotonic()
+        if use_cache and self._feeds_cache is not None and now - self._feeds_cache[0] < self._feeds_ttl:
+            return self._feeds_cache[1]
+
+        response = self.session.get(f"{self.BASE_URL}/v2/price_feeds", timeout=HERMES_TIMEOUT)
         response.raise_for_status()
-        return response.json()
+        data = msgspec.json.decode(response.content)
+        self._feeds_cache = (now, data)
+        return data
     
-    def get_latest_prices(self, feed_ids: List[str]) -> List[Dict]:
+    def get_latest_prices(self, feed_ids: List[str]) -> HermesPriceResponse:
+        key = tuple(sorted(feed_ids))
+        now = time.monotonic()
+        hit = self._price_cache.get(key)
+        if hit is not None and now - hit[0] < self._price_ttl:
+            return hit[1]
+
+        # Coalesce concurrent requests for the same feeds onto one Hermes call
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._inflight[key] = future
+        if not is_leader:
+            return future.result(timeout=INFLIGHT_WAIT_TIMEOUT)
+
+        try:
+            data = self._fetch_latest_prices(feed_ids)
+            self._store_price(key, now, data)
+            future.set_result(data)
+            return data
+        except BaseException as e:
+            # Release waiting callers even on KeyboardInterrupt, without re-raising
+            # the interrupt in their threads
+            if isinstance(e, Exception):
+                future.set_exception(e)
+            else:
+                future.set_exception(RuntimeError(f"Price request was interrupted: {e!r}"))
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+
+    def _store_price(self, key: Tuple[str, ...], now: float, data: HermesPriceResponse) -> None:
+        """Cache a price response, dropping entries that have already expired."""
+        # Snapshot the items so a concurrent writer can't resize the dict mid-iteration
+        price_cache = {
+            k: v for k, v in list(self._price_cache.items())
+            if now - v[0] < self._price_ttl
+        }
+        price_cache[key] = (now, data)
+        self._price_cache = price_cache
+
+    def _fetch_latest_prices(self, feed_ids: List[str]) -> HermesPriceResponse:
+        """Request the latest prices for the given feeds from Hermes."""
         url = f"{self.BASE_URL}/v2/updates/price/latest"
         query_params = [('ids[]', id_) for id_ in feed_ids]
         
@@ -52,15 +218,12 @@ class HermesClient:
             response = self.session.get(
                 url, 
                 params=query_params,
-                timeout=30  # Add timeout parameter
+                timeout=HERMES_TIMEOUT
             )
             response.raise_for_status()
             
-            data = response.json()
-            if not isinstance(data, dict) or 'parsed' not in data:
-                raise ValueError("Unexpected API response format")
-                
-            return data
+            # Hermes sends price and conf as strings; lax mode decodes them as floats
+            return msgspec.json.decode(response.content, type=HermesPriceResponse, strict=False)
             
         except requests.exceptions.Timeout:
             logger.error(f"Request timed out while fetching prices for feeds: {feed_ids}")
@@ -71,7 +234,7 @@ class HermesClient:
         except requests.exceptions.HTTPError as e:
             logger.error(f"HTTP error {response.status_code} while fetching prices: {e}")
             raise
-        except ValueError as e:
+        except msgspec.DecodeError as e:
             logger.error(f"Invalid response format from API: {e}")
             raise
         except Exception as e:
@@ -80,34 +243,98 @@ class HermesClient:
 
 class PriceService:
     """Service for processing price-related requests."""
+
+    # Static instructions sent ahead of every message so the prompt prefix stays cacheable
+    SYSTEM_PROMPT = dedent("""
+        Your name is Pythia. You are the price oracle of the Pyth Network. You speak truth and only truth.
+        You are a helpful assistant that can answer questions and provide information.
+        For now you tell the prices if you feel they have been asked.
+
+        Analyze the user's message:
+        1. Determine if it's asking for a price.
+        2. If yes, extract the symbols/tickers mentioned and convert them to proper format. Please use the known tickers list to match the tickers. Please analyze every word correctly as messages may contain spelling errors.
+        3. Use the known tickers list to return the tickers in the response. Find the closest match in the list.
+        4. If no, provide a friendly response to continue the conversation.
+    """).strip()
     
     def __init__(self):
         self.hermes_client = HermesClient(base_url=os.getenv('HERMES_API_BASE_URL'))
         self.openai_client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-        self.price_feeds = self.hermes_client.get_price_feeds()
-        self.tickers = []
-        for feed in self.price_feeds:
-            if "base" in feed["attributes"]:
-                self.tickers.append(feed["attributes"]["base"])
+        self._executor = ThreadPoolExecutor(max_workers=8)
+        # Per-instance cache of parsed GPT analyses keyed by normalized message
+        self._analyze_cached = lru_cache(maxsize=1024)(self._request_analysis)
+        # The feed catalog is fetched on first use and refreshed in the background
+        self._price_feeds: Optional[List[Dict]] = None
+        self._feed_index: Dict[str, List[PriceFeed]] = {}
+        self.tickers: List[str] = []
+        self._tickers_prompt = ""
+        self._feeds_lock = threading.Lock()
+        self._refresh_timer: Optional[threading.Timer] = None
+        # Most recent price answer, reused when the same tickers are asked again right away
+        self._last_tickers: frozenset = frozenset()
+        self._last_result_ts = 0.0
+        self._last_result: List[PriceData] = []
+
+    @property
+    def price_feeds(self) -> List[Dict]:
+        """Price feed catalog, fetched from Hermes on first access."""
+        self._ensure_price_feeds()
+        return self._price_feeds
+
+    def refresh_price_feeds(self, use_cache: bool = True) -> None:
+        """Fetch the price feed catalog and swap in a fresh ticker index."""
+        price_feeds = self.hermes_client.get_price_feeds(use_cache=use_cache)
+        # Index feeds by base ticker once so lookups don't rescan the catalog
+        feed_index: Dict[str, List[PriceFeed]] = {}
+        for item in price_feeds:
+            attributes = item.get("attributes") or {}
+            base = attributes.get("base")
+            if base:
+                feed_index.setdefault(base, []).append(
+                    PriceFeed(id=item["id"], description=attributes["description"])
+                )
+        self._feed_index = feed_index
+        tickers = list(feed_index)
+        if tickers != self.tickers:
+            self.tickers = tickers
+            self._tickers_prompt = f"Known tickers: {tickers}"
+            # Cached analyses were made against the previous ticker list
+            self._analyze_cached.cache_clear()
+        self._price_feeds = price_feeds
+
+    def _ensure_price_feeds(self) -> None:
+        """Load the feed catalog if needed and start the periodic refresh."""
+        if self._price_feeds is not None:
+            return
+        with self._feeds_lock:
+            if self._price_feeds is None:
+                self.refresh_price_feeds()
+                self._schedule_feed_refresh()
+
+    def _schedule_feed_refresh(self) -> None:
+        """Arm a daemon timer for the next catalog refresh."""
+        self._refresh_timer = threading.Timer(FEED_REFRESH_INTERVAL, self._refresh_in_background)
+        self._refresh_timer.daemon = True
+        self._refresh_timer.start()
+
+    def _refresh_in_background(self) -> None:
+        """Refresh the catalog from the timer thread, keeping the old one on failure."""
+        try:
+            self.refresh_price_feeds(use_cache=False)
+        except Exception as e:
+            logger.error(f"Error refreshing price feeds: {e}")
+        finally:
+            self._schedule_feed_refresh()
     
     def process_tickers(self, tickers: List[str]) -> List[PriceFeed]:
         """Process tickers and return corresponding price feeds."""
         if not tickers:
             return []
         
-        price_feeds = []
-        for ticker in tickers:
-            feeds = [
-                PriceFeed(
-                    id=item["id"],
-                    description=item["attributes"]["description"]
-                )
-                for item in self.price_feeds
-                if "base" in item["attributes"] 
-                and item["attributes"]["base"] == ticker
-            ]
-            price_feeds.extend(feeds)
-        return price_feeds
+        self._ensure_price_feeds()
+        return list(chain.from_iterable(
+            self._feed_index.get(ticker, ()) for ticker in tickers
+        ))
 
     def fetch_prices(self, tickers: List[str]) -> List[PriceData]:
         """Fetch prices for given tickers."""
@@ -117,66 +344,86 @@ class PriceService:
                 logger.warning(f"No price feeds found for tickers: {tickers}")
                 return []
 
-            feed_ids = [feed.id for feed in price_feeds]
-            response_data = self.hermes_client.get_latest_prices(feed_ids)
-            
-            return [
-                PriceData(
-                    id=price["id"],
-                    price=float(price["price"]["price"]) * 10 ** float(price["price"]["expo"]),
-                    confidence_interval=float(price["price"]["conf"]) * 10 ** float(price["price"]["expo"]),
-                    description=next(
-                        feed.description 
-                        for feed in price_feeds 
-                        if feed.id == price["id"]
-                    ),
-                    time=datetime.fromtimestamp(
-                        price["price"]["publish_time"],
-                        tz=pytz.UTC
-                    ).astimezone(pytz.timezone('America/New_York')).strftime("%Y-%m-%d %I:%M %p %Z")
-                )
-                for price in response_data["parsed"]
-            ]
+            desc_by_id = {feed.id: feed.description for feed in price_feeds}
+            feed_ids = list(desc_by_id)
+            parsed = self._get_latest_parsed(feed_ids)
+
+            prices = []
+            prices_append = prices.append
+            for price in parsed:
+                price_id = price.id
+                p = price.price
+                scale = _scale(p.expo)
+                prices_append(PriceData(
+                    id=price_id,
+                    price=p.price * scale,
+                    confidence_interval=p.conf * scale,
+                    description=desc_by_id.get(price_id, ""),
+                    time=_fmt_time(p.publish_time)
+                ))
+            return prices
             
         except requests.exceptions.RequestException as e:
             logger.error(f"Error fetching prices: {e}")
             raise
 
+    def _get_latest_parsed(self, feed_ids: List[str]) -> List[HermesPriceUpdate]:
+        """Fetch latest prices in bounded batches, requesting batches concurrently."""
+        batches = [
+            feed_ids[i:i + PRICE_BATCH_SIZE]
+            for i in range(0, len(feed_ids), PRICE_BATCH_SIZE)
+        ]
+        if len(batches) == 1:
+            responses = [self.hermes_client.get_latest_prices(batches[0])]
+        else:
+            responses = self._executor.map(self.hermes_client.get_latest_prices, batches)
+        return [price for response in responses for price in response.parsed]
+
     def analyze_message(self, message: str) -> Dict[str, Union[bool, List[str], str]]:
         """Analyze message for price requests using GPT."""
-        prompt = f"""
-
-        Your name is Pythia. You are the price oracle of the Pyth Network. You speak truth and only truth.
-        You are a helpful assistant that can answer questions and provide information.
-        For now you tell the prices if you feel they have been asked.
-
-        Analyze the following message:
-        1. Determine if it's asking for a price. Reply in True/False. Please make sure with capital first letter.
-        2. If yes, extract the symbols/tickers mentioned and convert them to proper format. Please use {self.tickers} list to match the tickers. Please analyze every word correctly as messages may contain spelling errors.
-        3. Use {self.tickers} list to return the tickers in the response. Find the closest match in the list.
-        4. If no, provide a friendly response to continue the conversation.
-
-        Message: "{message}"
-
-        Response format:
-        {{
-            "is_price_request": True/False,
-            "tickers": ["symbol1", "symbol2"],
-            "chat_response": "Response if not a price request"
-        }}
-        """
-        
         try:
-            response = self.openai_client.chat.completions.create(
-                model="gpt-4",
-                messages=[{"role": "system", "content": prompt}]
-            )
-            # print("response.choices[0].message.content: ", response.choices[0].message.content)
-            return eval(response.choices[0].message.content)
+            is_price_request, tickers, chat_response = self._analyze_cached(message.strip().lower())
+            return {
+                "is_price_request": is_price_request,
+                "tickers": list(tickers),
+                "chat_response": chat_response,
+            }
         except Exception as e:
             logger.error(f"Error processing message with GPT: {e}")
             raise
 
+    def _request_analysis(self, message: str) -> Tuple[bool, Tuple[str, ...], str]:
+        """Ask GPT to analyze a normalized message and return the parsed, immutable result.
+
+        Any unusable reply raises, so lru_cache never stores it.
+        """
+        self._ensure_price_feeds()
+        response = self.openai_client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": self.SYSTEM_PROMPT},
+                {"role": "system", "content": self._tickers_prompt},
+                {"role": "user", "content": message},
+            ],
+            response_format={"type": "json_schema", "json_schema": ANALYSIS_SCHEMA},
+            max_tokens=200,
+            temperature=0
+        )
+        choice = response.choices[0]
+        if choice.finish_reason == "length":
+            raise ValueError("GPT reply was truncated by the token limit")
+        if choice.message.refusal:
+            raise ValueError(f"GPT refused to analyze the message: {choice.message.refusal}")
+        if not choice.message.content:
+            raise ValueError("GPT returned an empty reply")
+
+        analysis = json.loads(choice.message.content)
+        return (
+            bool(analysis["is_price_request"]),
+            tuple(analysis["tickers"]),
+            analysis["chat_response"],
+        )
+
     def handle_message(self, message: str) -> Union[List[PriceData], str]:
         """Handle user message and return appropriate response."""
         try:
@@ -185,7 +432,13 @@ class PriceService:
             
             if analysis["is_price_request"]:
                 # print("analysis['tickers']: ", analysis["tickers"])
-                return self.fetch_prices(analysis["tickers"])
+                tickers = frozenset(analysis["tickers"])
+                now = time.monotonic()
+                if tickers == self._last_tickers and now - self._last_result_ts < LAST_RESULT_TTL:
+                    return self._last_result
+                result = self.fetch_prices(analysis["tickers"])
+                self._last_tickers, self._last_result_ts, self._last_result = tickers, now, result
+                return result
             else:
                 return analysis["chat_response"]
             